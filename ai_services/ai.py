@@ -1,82 +1,284 @@
-import base64
-import json
+import asyncio
+import hashlib
+import io
 import os
-from openai import OpenAI
+import re
+import uuid
+from functools import lru_cache
+
+import boto3
+import httpx
+import orjson
+import pybase64
+import tiktoken
+from botocore.exceptions import BotoCoreError, ClientError
+from openai import APITimeoutError, AsyncOpenAI, RateLimitError
+from tenacity import (
+    AsyncRetrying,
+    retry_if_exception_type,
+    stop_after_attempt,
+    wait_exponential_jitter,
+)
+from PIL import Image, ImageOps, UnidentifiedImageError
+
+import cache
+from batching import RequestBatcher
+from semantic_cache import OVERRIDE_PREFIX_RE, SemanticCache
 
 # fal.ai OpenRouter endpoint — OpenAI-compatible
 # Uses FAL_KEY for authentication, routes through OpenRouter to Gemini Flash 2.5
 FAL_KEY = os.environ.get("FAL_KEY", "")
 
-client = OpenAI(
-    api_key=FAL_KEY,
-    base_url="https://fal.run/openrouter/router/openai/v1",
-    default_headers={"Authorization": f"Key {FAL_KEY}"},
-)
+# Per-attempt limit; a slow tail response must not pin a worker for minutes.
+LLM_TIMEOUT = httpx.Timeout(30.0, connect=3.0)
+# Total time allowed per call, retries included.
+ID_VALIDATION_BUDGET = 45.0
+CHAT_BUDGET = 30.0
+# Per-attempt limit for chat, well inside CHAT_BUDGET so a timed-out attempt
+# can still be retried. When streaming, the read timeout bounds the wait for
+# the first token and every gap between tokens.
+CHAT_TIMEOUT = httpx.Timeout(10.0, connect=3.0)
+
+_client: AsyncOpenAI | None = None
+
+
+def get_client() -> AsyncOpenAI:
+    """
+    Process-wide shared client: the pooled HTTP/2 transport keeps TLS
+    connections to fal.run warm, so concurrent calls multiplex instead of
+    re-handshaking. Built on first use so every worker process gets its own
+    pool rather than inheriting sockets across fork().
+    """
+    global _client
+    if _client is None:
+        _client = AsyncOpenAI(
+            api_key=FAL_KEY,
+            base_url="https://fal.run/openrouter/router/openai/v1",
+            default_headers={"Authorization": f"Key {FAL_KEY}"},
+            # Fail fast and let _with_retries decide what is worth retrying.
+            timeout=LLM_TIMEOUT,
+            max_retries=0,
+            http_client=httpx.AsyncClient(
+                http2=True,
+                limits=httpx.Limits(
+                    max_keepalive_connections=100,
+                    max_connections=200,
+                    keepalive_expiry=60,
+                ),
+                timeout=LLM_TIMEOUT,
+            ),
+        )
+    return _client
+
+
+async def _with_retries(create, budget: float, **request):
+    """
+    Call create(**request), retrying timeouts and rate limits up to 3 attempts
+    with jittered exponential backoff. The whole call, retries included, is
+    cut off after budget seconds.
+    """
+    async with asyncio.timeout(budget):
+        async for attempt in AsyncRetrying(
+            stop=stop_after_attempt(3),
+            wait=wait_exponential_jitter(initial=0.5, max=4),
+            retry=retry_if_exception_type((APITimeoutError, RateLimitError)),
+            reraise=True,
+        ):
+            with attempt:
+                return await create(**request)
+
 
 VISION_MODEL = "google/gemini-2.5-flash"
 CHAT_MODEL = "google/gemini-2.5-flash"
 
+# Bump whenever a prompt changes so cached responses from the old one miss.
+PROMPT_VERSION = "v1"
+
+ID_MAX_TOKENS = 200
+ID_TEMPERATURE = 0
+
+# Large enough for reliable OCR of a CIN; phone photos are scaled down to this.
+ID_IMAGE_MAX_SIZE = (1280, 1280)
+ID_IMAGE_JPEG_QUALITY = 85
+# Pillow refuses images over twice this many pixels. A real ID photo is at
+# most a few tens of megapixels; a small file declaring a huge canvas is a
+# decompression bomb.
+Image.MAX_IMAGE_PIXELS = 50_000_000
+
+# Opening fence line (any language tag) and trailing ``` around a model's
+# JSON answer.
+_FENCE_RE = re.compile(r"^\s*```[^\n]*\n|\s*```\s*$")
+
+# Optional S3 bucket for staging ID images. When set, the model fetches the
+# image from a short-lived presigned URL instead of an inline base64 data URL.
+ID_UPLOAD_BUCKET = os.environ.get("ID_UPLOAD_BUCKET", "")
+ID_UPLOAD_URL_TTL = 600
+
+CHAT_MAX_TOKENS = 500
+CHAT_TEMPERATURE = 0.7
+# First-turn factual questions about the customer's own data. These are
+# answered at temperature 0 and cached; everything else is sampled, uncached.
+_FACTUAL_QUERY_RE = re.compile(
+    r"\b(balance|transactions?|recent|statement|solde|récente?s?|opérations?)\b"
+    r"|رصيد|معاملات|عمليات",
+    re.I,
+)
+# Advice wording sends a question down the sampled path even when it also
+# mentions balances or transactions ("should I invest my balance?").
+_ADVICE_QUERY_RE = re.compile(
+    r"\b(should|invest\w*|advi[cs]e|recommend\w*|sav(e|ing|ings)|budget\w*"
+    r"|conseil\w*|investi\w*|placer|dois-je|devrais|recommand\w*|épargn\w*)\b"
+    r"|نصيحة|أنصح|استثمار|ينبغي|هل يجب",
+    re.I,
+)
+# Token budget for prior turns; older messages beyond it are dropped.
+CHAT_HISTORY_MAX_TOKENS = 4000
+# Approximate per-message framing overhead (role, separators).
+_MESSAGE_OVERHEAD_TOKENS = 4
+
+
+def _prepare_id_image(image_bytes: bytes) -> bytes:
+    """Downscale and re-encode an uploaded ID photo as a compact JPEG."""
+    img = Image.open(io.BytesIO(image_bytes))
+    # Phone cameras store rotation in EXIF; apply it before dropping metadata.
+    img = ImageOps.exif_transpose(img)
+    img.thumbnail(ID_IMAGE_MAX_SIZE, Image.LANCZOS)
+
+    buf = io.BytesIO()
+    img.convert("RGB").save(buf, "JPEG", quality=ID_IMAGE_JPEG_QUALITY, optimize=True)
+    return buf.getvalue()
+
+
+@lru_cache(maxsize=1)
+def _s3_client():
+    return boto3.client("s3")
 
-def validate_national_id(image_bytes: bytes) -> dict:
+
+def _stage_id_image(image_bytes: bytes):
+    """Upload the image to ID_UPLOAD_BUCKET; returns (object key, presigned URL)."""
+    key = f"id-uploads/{uuid.uuid4().hex}.jpg"
+    s3 = _s3_client()
+    s3.put_object(
+        Bucket=ID_UPLOAD_BUCKET, Key=key, Body=image_bytes, ContentType="image/jpeg"
+    )
+    url = s3.generate_presigned_url(
+        "get_object",
+        Params={"Bucket": ID_UPLOAD_BUCKET, "Key": key},
+        ExpiresIn=ID_UPLOAD_URL_TTL,
+    )
+    return key, url
+
+
+def _delete_staged_image(key: str) -> None:
+    # Best effort: the presigned URL expires anyway, but ID scans should not linger.
+    try:
+        _s3_client().delete_object(Bucket=ID_UPLOAD_BUCKET, Key=key)
+    except (BotoCoreError, ClientError):
+        pass
+
+
+async def _id_image_url(image_bytes: bytes):
+    """Returns (staged object key or None, URL the model should fetch)."""
+    if ID_UPLOAD_BUCKET:
+        try:
+            return await asyncio.to_thread(_stage_id_image, image_bytes)
+        except (BotoCoreError, ClientError):
+            # S3 trouble should not fail the check; inline the image instead.
+            pass
+    base64_image = pybase64.b64encode_as_string(image_bytes)
+    return None, f"data:image/jpeg;base64,{base64_image}"
+
+
+def _strip_fences(raw: str) -> str:
+    """Strip markdown code fences if present."""
+    if raw.lstrip().startswith("{"):
+        return raw
+    return _FENCE_RE.sub("", raw)
+
+
+async def validate_national_id(image_bytes: bytes) -> dict:
     """
     Takes an image of an ID card, sends it to Gemini Flash 2.5 via fal.ai,
     and checks if it's a valid البطاقة الوطنية (Moroccan national ID card).
     Returns {"valid": bool, "idNumber": str|None, "error": str|None}
     """
-    base64_image = base64.b64encode(image_bytes).decode("utf-8")
-
-    response = client.chat.completions.create(
-        model=VISION_MODEL,
-        messages=[
-            {
-                "role": "system",
-                "content": (
-                    "You are an ID card verification system. You analyze images of identification documents. "
-                    "You must determine if the image is a valid Moroccan البطاقة الوطنية (Carte Nationale d'Identité). "
-                    "If it is, extract the CIN number (usually 1-2 letters followed by digits, e.g. AB123456). "
-                    "Respond ONLY with valid JSON, no markdown, no explanation."
-                ),
-            },
-            {
-                "role": "user",
-                "content": [
-                    {
-                        "type": "text",
-                        "text": (
-                            "Analyze this image. Is it a Moroccan البطاقة الوطنية (national ID card)? "
-                            "Look for indicators like: 'البطاقة الوطنية', 'CARTE NATIONALE', 'ROYAUME DU MAROC', 'المملكة المغربية'. "
-                            "If valid, extract the CIN number. "
-                            'Respond with JSON: {"valid": true/false, "idNumber": "XX123456" or null, "error": null or "reason"}'
-                        ),
-                    },
-                    {
-                        "type": "image_url",
-                        "image_url": {
-                            "url": f"data:image/jpeg;base64,{base64_image}",
-                            "detail": "high",
-                        },
-                    },
-                ],
-            },
-        ],
-        max_tokens=200,
-        temperature=0,
+    cache_key = cache.canonical_key(
+        "validate-id",
+        {
+            "promptVersion": PROMPT_VERSION,
+            "model": VISION_MODEL,
+            "temperature": ID_TEMPERATURE,
+            "maxTokens": ID_MAX_TOKENS,
+            "image": hashlib.sha256(image_bytes).hexdigest(),
+        },
     )
+    cached = await cache.get_json(cache_key)
+    if cached is not None:
+        return cached
 
-    raw = response.choices[0].message.content.strip()
+    try:
+        # Pillow is CPU-bound; keep it off the event loop.
+        image_bytes = await asyncio.to_thread(_prepare_id_image, image_bytes)
+    except (UnidentifiedImageError, Image.DecompressionBombError, OSError):
+        return {"valid": False, "idNumber": None, "error": "Unreadable image"}
 
-    # Strip markdown code fences if present
-    if raw.startswith("```"):
-        raw = raw.split("\n", 1)[-1].rsplit("```", 1)[0].strip()
+    upload_key, image_url = await _id_image_url(image_bytes)
+    try:
+        response = await _with_retries(
+            get_client().chat.completions.create,
+            ID_VALIDATION_BUDGET,
+            model=VISION_MODEL,
+            messages=[
+                {
+                    "role": "system",
+                    "content": (
+                        "You are an ID card verification system. You analyze images of identification documents. "
+                        "You must determine if the image is a valid Moroccan البطاقة الوطنية (Carte Nationale d'Identité). "
+                        "If it is, extract the CIN number (usually 1-2 letters followed by digits, e.g. AB123456). "
+                        "Respond ONLY with valid JSON, no markdown, no explanation."
+                    ),
+                },
+                {
+                    "role": "user",
+                    "content": [
+                        {
+                            "type": "text",
+                            "text": (
+                                "Analyze this image. Is it a Moroccan البطاقة الوطنية (national ID card)? "
+                                "Look for indicators like: 'البطاقة الوطنية', 'CARTE NATIONALE', 'ROYAUME DU MAROC', 'المملكة المغربية'. "
+                                "If valid, extract the CIN number. "
+                                'Respond with JSON: {"valid": true/false, "idNumber": "XX123456" or null, "error": null or "reason"}'
+                            ),
+                        },
+                        {
+                            "type": "image_url",
+                            "image_url": {
+                                "url": image_url,
+                                "detail": "high",
+                            },
+                        },
+                    ],
+                },
+            ],
+            max_tokens=ID_MAX_TOKENS,
+            temperature=ID_TEMPERATURE,
+        )
+    finally:
+        if upload_key is not None:
+            await asyncio.to_thread(_delete_staged_image, upload_key)
+
+    raw = response.choices[0].message.content
 
     try:
-        result = json.loads(raw)
-        return {
+        result = orjson.loads(_strip_fences(raw))
+        result = {
             "valid": bool(result.get("valid", False)),
             "idNumber": result.get("idNumber"),
             "error": result.get("error"),
         }
-    except json.JSONDecodeError:
+        await cache.set_json(cache_key, result, cache.ID_CACHE_TTL)
+        return result
+    except orjson.JSONDecodeError:
         return {
             "valid": False,
             "idNumber": None,
@@ -103,14 +305,14 @@ class BankChatbot:
         "you can give the user financial advices like specialist"
     )
 
+    # Built once; every request's message list starts with this prefix.
+    _SYS_MSG = ({"role": "system", "content": SYSTEM_PROMPT},)
+
     def __init__(self):
-        self.client = OpenAI(
-            api_key=FAL_KEY,
-            base_url="https://fal.run/openrouter/router/openai/v1",
-            default_headers={"Authorization": f"Key {FAL_KEY}"},
-        )
+        self.semantic_cache = SemanticCache()
+        self.batcher = RequestBatcher(get_client())
 
-    def chat(
+    async def chat(
         self, user_message: str, conversation_history: list, user_context: dict
     ) -> str:
         """
@@ -128,60 +330,239 @@ class BankChatbot:
         Returns:
             The assistant's response text
         """
-        # Build context summary from user data
-        context_block = self._build_context(user_context)
+        messages = self._build_messages(
+            user_message, conversation_history, user_context
+        )
 
-        messages = [
-            {"role": "system", "content": self.SYSTEM_PROMPT},
-            {"role": "system", "content": f"Customer data:\n{context_block}"},
-        ]
+        deterministic = _is_factual_query(user_message, conversation_history)
+        temperature = 0 if deterministic else CHAT_TEMPERATURE
+
+        cached, cache_key, embedding = await self._lookup_reply(
+            messages, user_message, user_context, temperature
+        )
+        if cached is not None:
+            return cached
 
-        # Add conversation history
-        for msg in conversation_history:
-            messages.append({"role": msg["role"], "content": msg["content"]})
+        response = await _with_retries(
+            self.batcher.submit,
+            CHAT_BUDGET,
+            model=CHAT_MODEL,
+            messages=messages,
+            max_tokens=CHAT_MAX_TOKENS,
+            temperature=temperature,
+            timeout=CHAT_TIMEOUT,
+        )
 
-        # Add the new user message
-        messages.append({"role": "user", "content": user_message})
+        reply = response.choices[0].message.content.strip()
+        await self._store_reply(reply, cache_key, embedding, user_context)
+        return reply
 
-        response = self.client.chat.completions.create(
+    async def chat_stream(
+        self, user_message: str, conversation_history: list, user_context: dict
+    ):
+        """
+        Streaming variant of chat(). Yields Server-Sent Events as tokens
+        arrive: `data: {"delta": "..."}` chunks, then `data: [DONE]`.
+        """
+        messages = self._build_messages(
+            user_message, conversation_history, user_context
+        )
+
+        deterministic = _is_factual_query(user_message, conversation_history)
+        temperature = 0 if deterministic else CHAT_TEMPERATURE
+
+        cached, cache_key, embedding = await self._lookup_reply(
+            messages, user_message, user_context, temperature
+        )
+        if cached is not None:
+            yield f"data: {orjson.dumps({'delta': cached}).decode()}\n\n"
+            yield "data: [DONE]\n\n"
+            return
+
+        response = await _with_retries(
+            get_client().chat.completions.create,
+            CHAT_BUDGET,
             model=CHAT_MODEL,
             messages=messages,
-            max_tokens=500,
-            temperature=0.7,
+            max_tokens=CHAT_MAX_TOKENS,
+            temperature=temperature,
+            stream=True,
+            timeout=CHAT_TIMEOUT,
+        )
+
+        parts = []
+        # Closing the stream on exit matters when the SSE client disconnects
+        # mid-reply: otherwise the upstream response (and billed generation)
+        # stays open until garbage collection.
+        async with response:
+            async for chunk in response:
+                if not chunk.choices:
+                    continue
+                delta = chunk.choices[0].delta.content
+                if delta:
+                    parts.append(delta)
+                    yield f"data: {orjson.dumps({'delta': delta}).decode()}\n\n"
+
+        await self._store_reply(
+            "".join(parts).strip(), cache_key, embedding, user_context
+        )
+        yield "data: [DONE]\n\n"
+
+    async def _lookup_reply(
+        self,
+        messages: list,
+        user_message: str,
+        user_context: dict,
+        temperature: float,
+    ):
+        """
+        Check the exact-match cache, then the semantic cache.
+        Returns (cached_reply or None, cache_key or None, embedding or None).
+        Sampled (temperature > 0) replies are never cached.
+        """
+        if temperature > 0:
+            return None, None, None
+
+        cache_key = self._cache_key(messages, temperature)
+        cached = await cache.get_json(cache_key)
+        if cached is not None:
+            return cached, cache_key, None
+
+        # Embedding is CPU-bound; run it in a worker thread.
+        cached, embedding = await asyncio.to_thread(
+            self.semantic_cache.lookup, user_message, user_context
+        )
+        return cached, cache_key, embedding
+
+    async def _store_reply(
+        self, reply: str, cache_key, embedding, user_context: dict
+    ) -> None:
+        if cache_key is None:
+            return
+        await cache.set_json(cache_key, reply, cache.CHAT_CACHE_TTL)
+        if embedding is not None:
+            self.semantic_cache.store(embedding, reply, user_context)
+
+    def _cache_key(self, messages: list, temperature: float) -> str:
+        """Cache key over every input that shapes the completion."""
+        return cache.canonical_key(
+            "chat",
+            {
+                "promptVersion": PROMPT_VERSION,
+                "model": CHAT_MODEL,
+                "messages": messages,
+                "temperature": temperature,
+                "maxTokens": CHAT_MAX_TOKENS,
+            },
         )
 
-        return response.choices[0].message.content.strip()
+    def _build_messages(
+        self, user_message: str, conversation_history: list, user_context: dict
+    ) -> list:
+        """
+        Assemble the prompt from most to least stable: system prompt, history,
+        customer data, new message. Keeping the per-request customer data after
+        the history lets the provider's prefix cache reuse system + history.
+        """
+        # Build context summary from user data
+        context_block = self._build_context(user_context)
+
+        # Only role and content go on; extra client fields would reach the
+        # provider and destabilize the cache key.
+        return [
+            *self._SYS_MSG,
+            *(
+                {"role": m["role"], "content": m["content"]}
+                for m in _truncate_history(conversation_history)
+            ),
+            {"role": "system", "content": f"Customer data:\n{context_block}"},
+            {"role": "user", "content": user_message},
+        ]
 
     def _build_context(self, user_context: dict) -> str:
         """Format user's banking data into a readable context string."""
-        parts = []
+        # Snapshots rarely change between turns, so the rendered text is
+        # memoized on the canonical JSON of the context.
+        return _render_context(
+            orjson.dumps(user_context, option=orjson.OPT_SORT_KEYS)
+        )
+
+
+def _is_factual_query(user_message: str, conversation_history: list) -> bool:
+    """
+    Cheap router: a first-turn question about balances or transactions that
+    does not ask for advice.
+    """
+    if conversation_history:
+        return False
+    question = OVERRIDE_PREFIX_RE.sub("", user_message)
+    if _ADVICE_QUERY_RE.search(question):
+        return False
+    return _FACTUAL_QUERY_RE.search(question) is not None
+
+
+@lru_cache(maxsize=1)
+def get_encoding():
+    # Gemini has no public tokenizer; cl100k is close enough for budgeting.
+    return tiktoken.encoding_for_model("gpt-4")
+
+
+def _truncate_history(
+    history: list, max_tokens: int = CHAT_HISTORY_MAX_TOKENS
+) -> list:
+    """Keep the most recent messages that fit within max_tokens."""
+    encoding = get_encoding()
+    budget = max_tokens
+    kept = 0
+    for msg in reversed(history):
+        # User text may contain strings like "<|endoftext|>"; count them as text.
+        tokens = encoding.encode(msg.get("content") or "", disallowed_special=())
+        cost = len(tokens) + _MESSAGE_OVERHEAD_TOKENS
+        if cost > budget:
+            break
+        budget -= cost
+        kept += 1
+    return history[len(history) - kept :]
+
+
+@lru_cache(maxsize=1024)
+def _render_context(context_json: bytes) -> str:
+    user_context = orjson.loads(context_json)
+    parts = []
+
+    name = user_context.get("userName", "Customer")
+    parts.append(f"Customer: {name}")
+
+    accounts = user_context.get("accounts", [])
+    if accounts:
+        parts.append("\nAccounts:")
+        for acc in accounts:
+            masked = "***" + acc.get("accountNumber", "")[-4:]
+            parts.append(
+                f"  - {acc.get('type', 'Account')} ({masked}): "
+                f"{acc.get('balance', 0):.2f} {acc.get('currency', 'USD')} "
+                f"[Status: {acc.get('status', 'Active')}]"
+            )
+
+    transactions = user_context.get("recentTransactions", [])
+    if transactions:
+        parts.append(f"\nRecent Transactions (last {len(transactions)}):")
+        for tx in transactions:
+            parts.append(
+                f"  - [{tx.get('date', '')}] {tx.get('type', '')}: "
+                f"{tx.get('amount', 0):+.2f} USD — {tx.get('description', 'N/A')} "
+                f"(Balance after: {tx.get('balanceAfter', 0):.2f})"
+            )
+
+    return "\n".join(parts)
+
+
+_chatbot: BankChatbot | None = None
+
 
-        name = user_context.get("userName", "Customer")
-        parts.append(f"Customer: {name}")
-
-        accounts = user_context.get("accounts", [])
-        if accounts:
-            parts.append("\nAccounts:")
-            for acc in accounts:
-                masked = "***" + acc.get("accountNumber", "")[-4:]
-                parts.append(
-                    f"  - {acc.get('type', 'Account')} ({masked}): "
-                    f"{acc.get('balance', 0):.2f} {acc.get('currency', 'USD')} "
-                    f"[Status: {acc.get('status', 'Active')}]"
-                )
-
-        transactions = user_context.get("recentTransactions", [])
-        if transactions:
-            parts.append(f"\nRecent Transactions (last {len(transactions)}):")
-            for tx in transactions:
-                parts.append(
-                    f"  - [{tx.get('date', '')}] {tx.get('type', '')}: "
-                    f"{tx.get('amount', 0):+.2f} USD — {tx.get('description', 'N/A')} "
-                    f"(Balance after: {tx.get('balanceAfter', 0):.2f})"
-                )
-
-        return "\n".join(parts)
-
-
-# Singleton instance
-chatbot = BankChatbot()
+def get_chatbot() -> BankChatbot:
+    """Per-process singleton, created lazily (after any worker fork)."""
+    global _chatbot
+    if _chatbot is None:
+        _chatbot = BankChatbot()
+    return _chatbot
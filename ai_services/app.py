@@ -1,39 +1,113 @@
-from flask import Flask, request, jsonify
-from ai import validate_national_id, chatbot
+import asyncio
 
-app = Flask(__name__)
+import orjson
+from quart import Quart, Response, request, jsonify, stream_with_context
+from quart.json.provider import DefaultJSONProvider
+from ai import validate_national_id, get_chatbot
+import jobs
+
+
+class OrjsonProvider(DefaultJSONProvider):
+    """Quart JSON provider backed by orjson for request parsing and jsonify."""
+
+    def dumps(self, obj, **kwargs) -> str:
+        return orjson.dumps(obj, default=self.default).decode()
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
+
+app = Quart(__name__)
+app.json = OrjsonProvider(app)
+# Quart buffers the whole body before a handler sees request.files, so this
+# cap is what bounds memory per request; oversized bodies get a 413.
+app.config["MAX_CONTENT_LENGTH"] = 8 * 1024 * 1024
+
+
+def _sniff_image_type(header: bytes):
+    """Identify JPEG/PNG/WebP from the file's magic bytes; None otherwise."""
+    if header.startswith(b"\xff\xd8\xff"):
+        return "image/jpeg"
+    if header.startswith(b"\x89PNG\r\n\x1a\n"):
+        return "image/png"
+    if header[:4] == b"RIFF" and header[8:12] == b"WEBP":
+        return "image/webp"
+    return None
+
+
+@app.errorhandler(413)
+async def too_large(_error):
+    error = "Request too large (max 8 MB)"
+    if request.path.startswith("/validate-id"):
+        return jsonify({"valid": False, "idNumber": None, "error": error}), 413
+    return jsonify({"error": error}), 413
 
 
 @app.route("/validate-id", methods=["POST"])
-def validate_id():
-    if "image" not in request.files:
+async def validate_id():
+    files = await request.files
+    if "image" not in files:
         return jsonify(
             {"valid": False, "idNumber": None, "error": "No image file provided"}
         ), 400
 
-    file = request.files["image"]
+    file = files["image"]
     if file.filename == "":
         return jsonify(
             {"valid": False, "idNumber": None, "error": "Empty filename"}
         ), 400
 
-    allowed = {"image/jpeg", "image/png", "image/jpg", "image/webp"}
-    if file.content_type not in allowed:
+    # Trust the file's own bytes, not the client-supplied content type. The
+    # body is already buffered here; this check is about type, not memory.
+    header = file.stream.read(32)
+    if len(header) == 0:
+        return jsonify({"valid": False, "idNumber": None, "error": "Empty file"}), 400
+    if _sniff_image_type(header) is None:
         return jsonify(
             {"valid": False, "idNumber": None, "error": "Invalid file type"}
         ), 400
 
+    file.stream.seek(0)
     image_bytes = file.read()
-    if len(image_bytes) == 0:
-        return jsonify({"valid": False, "idNumber": None, "error": "Empty file"}), 400
 
-    result = validate_national_id(image_bytes)
-    status = 200 if result["valid"] else 400
-    return jsonify(result), status
+    if jobs.queue is None:
+        result = await validate_national_id(image_bytes)
+        status = 200 if result["valid"] else 400
+        return jsonify(result), status
+
+    # Hand the model call to the RQ worker; the client polls for the result.
+    job_id = await asyncio.to_thread(jobs.enqueue_validation, image_bytes)
+    return jsonify({"jobId": job_id, "status": "queued"}), 202
+
+
+@app.route("/validate-id/<job_id>", methods=["GET"])
+async def validate_id_status(job_id):
+    """
+    Poll a queued validation. Returns 202 {"jobId", "status"} while pending,
+    then the same body and status codes as a synchronous /validate-id.
+    """
+    job = None
+    if jobs.queue is not None:
+        job = await asyncio.to_thread(jobs.fetch_validation, job_id)
+    if job is None:
+        return jsonify({"error": "Unknown or expired job"}), 404
+
+    status = await asyncio.to_thread(job.get_status)
+    if status == "finished":
+        result = await asyncio.to_thread(job.return_value)
+        if result is None:
+            return jsonify({"error": "Unknown or expired job"}), 404
+        return jsonify(result), 200 if result["valid"] else 400
+    if status in ("failed", "stopped", "canceled"):
+        return jsonify(
+            {"valid": False, "idNumber": None, "error": "Validation failed"}
+        ), 500
+
+    return jsonify({"jobId": job_id, "status": status}), 202
 
 
 @app.route("/chat", methods=["POST"])
-def chat():
+async def chat():
     """
     Chat endpoint. Expects JSON:
     {
@@ -43,11 +117,16 @@ def chat():
             "userName": "...",
             "accounts": [...],
             "recentTransactions": [...]
-        }
+        },
+        "stream": false
     }
     Returns: {"reply": "assistant's response"}
+
+    With "stream": true (or an `Accept: text/event-stream` header) the reply
+    is streamed as Server-Sent Events: `data: {"delta": "..."}` per chunk,
+    terminated by `data: [DONE]`.
     """
-    data = request.get_json()
+    data = await request.get_json()
     if not data or "message" not in data:
         return jsonify({"error": "Missing 'message' field"}), 400
 
@@ -55,20 +134,44 @@ def chat():
     history = data.get("conversationHistory", [])
     user_context = data.get("userContext", {})
 
+    wants_stream = data.get("stream") is True or (
+        request.accept_mimetypes.best == "text/event-stream"
+    )
+    if wants_stream:
+
+        @stream_with_context
+        async def generate():
+            try:
+                async for event in get_chatbot().chat_stream(
+                    message, history, user_context
+                ):
+                    yield event
+            except Exception as e:
+                error = {"error": f"Chat service error: {str(e)}"}
+                yield f"data: {orjson.dumps(error).decode()}\n\n"
+
+        return Response(
+            generate(),
+            mimetype="text/event-stream",
+            headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+        )
+
     try:
-        reply = chatbot.chat(message, history, user_context)
+        reply = await get_chatbot().chat(message, history, user_context)
         return jsonify({"reply": reply}), 200
     except Exception as e:
         return jsonify({"error": f"Chat service error: {str(e)}"}), 500
 
 
 @app.route("/health", methods=["GET"])
-def health():
+async def health():
     return jsonify({"status": "healthy"}), 200
 
 
 if __name__ == "__main__":
     import os
 
+    import uvicorn
+
     port = int(os.environ.get("PORT", 8000))
-    app.run(host="0.0.0.0", port=port)
+    uvicorn.run(app, host="0.0.0.0", port=port)
@@ -0,0 +1,91 @@
+import asyncio
+from functools import partial
+
+# Coalescing window: when requests are already queued behind the first one,
+# wait up to this many seconds for more, up to MAX_BATCH_SIZE at a time. A
+# request that arrives alone is sent immediately.
+BATCH_WINDOW = 0.03
+MAX_BATCH_SIZE = 8
+
+
+class RequestBatcher:
+    """
+    Collects concurrent chat completion requests into small batches and
+    starts each batch together, so the requests go out as one burst over the
+    shared HTTP/2 connection. Every caller awaits its own future, which is
+    resolved as soon as that request's call completes.
+    """
+
+    def __init__(self, client):
+        self._client = client
+        self._queue = None
+        self._worker = None
+        # Strong references so in-flight dispatch tasks are not garbage collected.
+        self._dispatches = set()
+
+    async def submit(self, **request):
+        """Queue a chat.completions.create(**request) call and await its result."""
+        self._ensure_worker()
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put((request, future))
+        return await future
+
+    def _ensure_worker(self):
+        # Created lazily so the queue and task belong to the serving event loop.
+        if self._worker is None or self._worker.done():
+            self._queue = asyncio.Queue()
+            self._worker = asyncio.create_task(self._run())
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self._queue.get()]
+            # Nothing else waiting: holding a lone request back only adds latency.
+            if self._queue.empty():
+                self._dispatch(batch)
+                continue
+
+            deadline = loop.time() + BATCH_WINDOW
+            while len(batch) < MAX_BATCH_SIZE:
+                remaining = deadline - loop.time()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(
+                        await asyncio.wait_for(self._queue.get(), remaining)
+                    )
+                except asyncio.TimeoutError:
+                    break
+
+            self._dispatch(batch)
+
+    def _dispatch(self, batch):
+        # Start the whole batch at once, but resolve each caller as soon as its
+        # own call finishes rather than waiting on the slowest one.
+        for request, future in batch:
+            # The caller gave up (timeout or disconnect) while queued.
+            if future.cancelled():
+                continue
+            task = asyncio.create_task(self._client.chat.completions.create(**request))
+            self._dispatches.add(task)
+            task.add_done_callback(self._dispatches.discard)
+            task.add_done_callback(partial(_resolve, future))
+            future.add_done_callback(partial(_cancel_if_abandoned, task))
+
+
+def _resolve(future, task):
+    """Copy a finished call's outcome onto the caller's future."""
+    if future.done():
+        return
+    if task.cancelled():
+        future.cancel()
+    elif task.exception() is not None:
+        future.set_exception(task.exception())
+    else:
+        future.set_result(task.result())
+
+
+def _cancel_if_abandoned(task, future):
+    """Stop an in-flight call once its caller has stopped waiting for it."""
+    if future.cancelled():
+        task.cancel()
@@ -0,0 +1,64 @@
+import hashlib
+import os
+
+import orjson
+import redis.asyncio as redis
+
+# Exact-match response cache for LLM calls, backed by Redis.
+# Disabled (every lookup misses) when REDIS_URL is not configured.
+REDIS_URL = os.environ.get("REDIS_URL", "")
+
+# CIN extraction is deterministic, so ID results can live for days.
+ID_CACHE_TTL = 7 * 24 * 3600
+# Only temperature-0 chat replies are cached; keep them briefly all the same.
+CHAT_CACHE_TTL = 5 * 60
+# A slow Redis must read as a miss, not stall the request behind it.
+REDIS_TIMEOUT = 0.5
+
+_redis = None
+
+
+def _get_redis():
+    # Connected lazily so each worker process opens its own pool after fork.
+    global _redis
+    if _redis is None and REDIS_URL:
+        _redis = redis.Redis.from_url(
+            REDIS_URL,
+            socket_timeout=REDIS_TIMEOUT,
+            socket_connect_timeout=REDIS_TIMEOUT,
+        )
+    return _redis
+
+
+def canonical_key(namespace: str, payload: dict) -> str:
+    """
+    Build a stable cache key from the request fields that determine the
+    response. Callers must leave out volatile fields (timestamps, request ids).
+    """
+    # Sorted keys, compact separators, non-ASCII written as raw UTF-8.
+    canonical = orjson.dumps(payload, option=orjson.OPT_SORT_KEYS)
+    digest = hashlib.sha256(canonical).hexdigest()
+    return f"{namespace}:{digest}"
+
+
+async def get_json(key: str):
+    """Return the cached value for key, or None on a miss or Redis failure."""
+    client = _get_redis()
+    if client is None:
+        return None
+    try:
+        raw = await client.get(key)
+    except redis.RedisError:
+        return None
+    return orjson.loads(raw) if raw is not None else None
+
+
+async def set_json(key: str, value, ttl: int) -> None:
+    """Store value under key for ttl seconds. Cache failures are not fatal."""
+    client = _get_redis()
+    if client is None:
+        return
+    try:
+        await client.setex(key, ttl, orjson.dumps(value))
+    except redis.RedisError:
+        pass
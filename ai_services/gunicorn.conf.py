@@ -0,0 +1,22 @@
+import os
+
+bind = f"0.0.0.0:{os.environ.get('PORT', 8000)}"
+workers = int(os.environ.get("WEB_CONCURRENCY", 4))
+# Uvicorn's worker picks up uvloop and httptools when they are installed.
+worker_class = "uvicorn.workers.UvicornWorker"
+
+
+def post_fork(server, worker):
+    # Build the chatbot (and its HTTP pool) inside each worker, never in the
+    # master, so no connection is shared across fork(). The tokenizer and the
+    # embedding model are loaded here too, so the first chat does not block
+    # the event loop on them.
+    from ai import get_chatbot, get_encoding
+
+    chatbot = get_chatbot()
+    get_encoding()
+    try:
+        chatbot.semantic_cache.load_model()
+    except Exception as e:
+        # The semantic cache is optional; chat works (uncached) without it.
+        server.log.warning("Embedding model not loaded: %s", e)
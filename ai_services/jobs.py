@@ -0,0 +1,84 @@
+import asyncio
+import os
+import uuid
+
+from redis import Redis
+from rq import Queue, Retry
+from rq.exceptions import NoSuchJobError
+from rq.job import Job
+
+from ai import validate_national_id
+from cache import REDIS_URL
+
+# Background ID validation on an RQ queue, opt-in via ID_VALIDATION_ASYNC
+# (which also needs REDIS_URL). start.sh runs the worker next to the app:
+#   rq worker validate-id --with-scheduler --url "$REDIS_URL"
+# Otherwise the queue is disabled and /validate-id answers inline.
+ID_VALIDATION_ASYNC = os.environ.get("ID_VALIDATION_ASYNC", "").lower() in (
+    "1",
+    "true",
+    "yes",
+)
+QUEUE_NAME = "validate-id"
+
+# Uploaded bytes and finished results are kept for 10 minutes.
+UPLOAD_TTL = 10 * 60
+RESULT_TTL = 10 * 60
+JOB_TIMEOUT = 120
+# Model timeouts and rate limits come in spikes; retry later, well within
+# UPLOAD_TTL so the parked image is still there.
+JOB_RETRY = Retry(max=3, interval=[5, 15, 30])
+
+_connection = (
+    Redis.from_url(REDIS_URL) if ID_VALIDATION_ASYNC and REDIS_URL else None
+)
+queue = (
+    Queue(QUEUE_NAME, connection=_connection) if _connection is not None else None
+)
+
+_loop = None
+
+
+def enqueue_validation(image_bytes: bytes) -> str:
+    """Park the image in Redis, queue a validation job and return its id."""
+    upload_key = f"validate-id:upload:{uuid.uuid4().hex}"
+    _connection.setex(upload_key, UPLOAD_TTL, image_bytes)
+    job = queue.enqueue(
+        validate_national_id_job,
+        upload_key,
+        job_timeout=JOB_TIMEOUT,
+        result_ttl=RESULT_TTL,
+        failure_ttl=RESULT_TTL,
+        retry=JOB_RETRY,
+    )
+    return job.id
+
+
+def fetch_validation(job_id: str):
+    """Return the RQ job for job_id, or None if it is unknown or expired."""
+    try:
+        return Job.fetch(job_id, connection=_connection)
+    except NoSuchJobError:
+        return None
+
+
+def validate_national_id_job(upload_key: str) -> dict:
+    """RQ entry point: load the parked upload and run the validation."""
+    image_bytes = _connection.get(upload_key)
+    if image_bytes is None:
+        return {"valid": False, "idNumber": None, "error": "Upload expired"}
+
+    result = _run(validate_national_id(image_bytes))
+    # Only drop the upload once we have an answer, so a retry can reuse it.
+    _connection.delete(upload_key)
+    return result
+
+
+def _run(coro):
+    # The async HTTP and Redis pools are bound to the loop that first used
+    # them. RQ's default worker forks a fresh work-horse per job, so this is a
+    # new loop each time; an in-process worker (SimpleWorker) reuses it.
+    global _loop
+    if _loop is None:
+        _loop = asyncio.new_event_loop()
+    return _loop.run_until_complete(coro)
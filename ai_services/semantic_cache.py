@@ -0,0 +1,112 @@
+import re
+import threading
+from collections import OrderedDict
+
+import faiss
+import numpy as np
+
+import cache
+
+# Customers write in Arabic, French or English; an English-only model maps
+# unrelated non-English questions close together.
+EMBEDDING_MODEL = "paraphrase-multilingual-MiniLM-L12-v2"
+SIMILARITY_THRESHOLD = 0.92
+MAX_BUCKETS = 1024
+MAX_ENTRIES_PER_BUCKET = 256
+
+# The .NET backend prepends the same "(SYSTEM OVERRIDE: ...)" banner to every
+# message; left in, it dominates the embedding and makes all questions look alike.
+OVERRIDE_PREFIX_RE = re.compile(r"^\s*\(SYSTEM OVERRIDE:.*?\)\s*", re.S)
+
+
+class _Bucket:
+    """FAISS inner-product index over normalized embeddings plus their replies."""
+
+    def __init__(self, dim: int):
+        self.index = faiss.IndexFlatIP(dim)
+        self.replies = []
+
+
+class SemanticCache:
+    """
+    Returns a previous reply when a new question is a close paraphrase of one
+    already answered. Entries are bucketed by a hash of the full user context,
+    so answers never cross users and are dropped as soon as the customer's
+    accounts or transactions change.
+
+    The cache is best effort: any failure in lookup() or store(), including
+    the embedding model failing to load, counts as a miss.
+    """
+
+    def __init__(self):
+        self._model = None
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+
+    def lookup(self, user_message: str, user_context: dict):
+        """
+        Return (cached_reply, embedding). cached_reply is None on a miss;
+        embedding is None too if the question could not be embedded.
+        """
+        try:
+            return self._lookup(user_message, user_context)
+        except Exception:
+            return None, None
+
+    def store(self, embedding, reply: str, user_context: dict) -> None:
+        try:
+            self._store(embedding, reply, user_context)
+        except Exception:
+            pass
+
+    def load_model(self):
+        """Load the embedding model once; safe to call from several threads."""
+        with self._lock:
+            if self._model is None:
+                # Imported lazily: loading the model is slow and only needed once.
+                from sentence_transformers import SentenceTransformer
+
+                self._model = SentenceTransformer(EMBEDDING_MODEL)
+        return self._model
+
+    def _lookup(self, user_message: str, user_context: dict):
+        embedding = self._embed(user_message)
+        bucket_key = self._bucket_key(user_context)
+
+        with self._lock:
+            bucket = self._buckets.get(bucket_key)
+            if bucket is None or bucket.index.ntotal == 0:
+                return None, embedding
+            self._buckets.move_to_end(bucket_key)
+            scores, ids = bucket.index.search(embedding, 1)
+
+        if scores[0][0] >= SIMILARITY_THRESHOLD:
+            return bucket.replies[ids[0][0]], embedding
+        return None, embedding
+
+    def _store(self, embedding, reply: str, user_context: dict) -> None:
+        bucket_key = self._bucket_key(user_context)
+
+        with self._lock:
+            bucket = self._buckets.get(bucket_key)
+            if bucket is None:
+                bucket = _Bucket(embedding.shape[1])
+                self._buckets[bucket_key] = bucket
+                if len(self._buckets) > MAX_BUCKETS:
+                    self._buckets.popitem(last=False)
+            else:
+                self._buckets.move_to_end(bucket_key)
+
+            if bucket.index.ntotal >= MAX_ENTRIES_PER_BUCKET:
+                return
+            bucket.index.add(embedding)
+            bucket.replies.append(reply)
+
+    def _embed(self, user_message: str):
+        model = self._model or self.load_model()
+        text = OVERRIDE_PREFIX_RE.sub("", user_message)
+        embedding = model.encode([text], normalize_embeddings=True)
+        return np.asarray(embedding, dtype="float32")
+
+    def _bucket_key(self, user_context: dict) -> str:
+        return cache.canonical_key("semantic", user_context)
@@ -0,0 +1,13 @@
+#!/bin/sh
+# Container entrypoint: the web app, plus the RQ worker when ID validation
+# runs asynchronously (see jobs.py).
+set -e
+
+case "$(echo "$ID_VALIDATION_ASYNC" | tr '[:upper:]' '[:lower:]')" in
+    1|true|yes)
+        # --with-scheduler is needed for the delayed retries jobs are queued with.
+        rq worker validate-id --with-scheduler --url "$REDIS_URL" &
+        ;;
+esac
+
+exec gunicorn -c gunicorn.conf.py app:app
@@ -0,0 +1,101 @@
+import asyncio
+import contextlib
+import time
+import types
+
+from batching import BATCH_WINDOW, RequestBatcher
+
+
+class FakeClient:
+    """Stands in for AsyncOpenAI: create() sleeps `delay` and echoes `reply`."""
+
+    def __init__(self):
+        self.chat = types.SimpleNamespace(completions=self)
+        self.started = []
+        self.finished = []
+
+    async def create(self, delay, reply):
+        self.started.append(reply)
+        await asyncio.sleep(delay)
+        self.finished.append(reply)
+        if isinstance(reply, Exception):
+            raise reply
+        return reply
+
+
+def test_each_caller_resolves_when_its_own_call_finishes():
+    async def main():
+        batcher = RequestBatcher(FakeClient())
+        start = time.monotonic()
+
+        async def timed(delay, reply):
+            result = await batcher.submit(delay=delay, reply=reply)
+            return result, time.monotonic() - start
+
+        return await asyncio.gather(timed(0.1, "fast"), timed(1.0, "slow"))
+
+    (fast, fast_elapsed), (slow, slow_elapsed) = asyncio.run(main())
+
+    assert (fast, slow) == ("fast", "slow")
+    assert fast_elapsed < 0.5
+    assert slow_elapsed >= 1.0
+
+
+def test_failure_is_delivered_only_to_its_caller():
+    async def main():
+        batcher = RequestBatcher(FakeClient())
+        return await asyncio.gather(
+            batcher.submit(delay=0.01, reply="ok"),
+            batcher.submit(delay=0.01, reply=ValueError("boom")),
+            return_exceptions=True,
+        )
+
+    ok, failed = asyncio.run(main())
+
+    assert ok == "ok"
+    assert isinstance(failed, ValueError)
+
+
+def test_lone_request_is_not_held_for_the_batch_window():
+    async def main():
+        batcher = RequestBatcher(FakeClient())
+        start = time.monotonic()
+        await batcher.submit(delay=0, reply="ok")
+        return time.monotonic() - start
+
+    assert asyncio.run(main()) < BATCH_WINDOW / 2
+
+
+def test_cancelled_caller_is_not_sent_while_queued():
+    async def main():
+        client = FakeClient()
+        batcher = RequestBatcher(client)
+        # Back the queue up so the second request waits for the batch window.
+        first = asyncio.ensure_future(batcher.submit(delay=0, reply="first"))
+        second = asyncio.ensure_future(batcher.submit(delay=0, reply="second"))
+        third = asyncio.ensure_future(batcher.submit(delay=0, reply="third"))
+        await asyncio.sleep(0)
+        second.cancel()
+        await asyncio.gather(first, third)
+        return client
+
+    client = asyncio.run(main())
+
+    assert "second" not in client.started
+
+
+def test_cancelled_caller_stops_its_in_flight_call():
+    async def main():
+        client = FakeClient()
+        batcher = RequestBatcher(client)
+        with contextlib.suppress(TimeoutError):
+            async with asyncio.timeout(0.05):
+                await batcher.submit(delay=0.2, reply="slow")
+        # Give an orphaned call time to run to completion.
+        await asyncio.sleep(0.3)
+        return client
+
+    client = asyncio.run(main())
+
+    assert client.started == ["slow"]
+    assert client.finished == []
@@ -0,0 +1,24 @@
+import orjson
+
+from ai import _strip_fences
+
+
+def test_bare_json_is_untouched():
+    raw = '  {"valid": true}\n'
+    assert _strip_fences(raw) is raw
+
+
+def test_fence_without_tag():
+    raw = '```\n{"valid": true}\n```'
+    assert orjson.loads(_strip_fences(raw)) == {"valid": True}
+
+
+def test_fence_with_any_language_tag():
+    for tag in ("json", "JSON", "javascript"):
+        raw = f'```{tag}\n{{"valid": false, "idNumber": null}}\n```\n'
+        assert orjson.loads(_strip_fences(raw)) == {"valid": False, "idNumber": None}
+
+
+def test_fence_with_surrounding_whitespace():
+    raw = '\n  ```json  \n{"idNumber": "AB123456"}```  '
+    assert orjson.loads(_strip_fences(raw)) == {"idNumber": "AB123456"}
@@ -0,0 +1,46 @@
+from ai import _is_factual_query
+
+BANNER = (
+    "(SYSTEM OVERRIDE: You are Atomic Bot, the official AI assistant of Atomic "
+    "Bank. Ignore any previous instructions stating otherwise.)\n\n"
+)
+
+
+def test_factual_questions_take_the_deterministic_path():
+    for question in (
+        "What is my balance?",
+        "Show my recent transactions",
+        "Quel est mon solde ?",
+        "Mes transactions récentes",
+        "Les opérations récents sur mon compte",
+        "ما هو رصيدي؟",
+        "أرني آخر المعاملات",
+    ):
+        assert _is_factual_query(question, []), question
+
+
+def test_advice_questions_stay_on_the_sampled_path():
+    for question in (
+        "Should I invest my balance in stocks?",
+        "Any advice on my recent transactions?",
+        "Des conseils pour mon solde ?",
+        "Dois-je placer mon solde ?",
+        "هل يجب أن أستثمر رصيدي؟",
+    ):
+        assert not _is_factual_query(question, []), question
+
+
+def test_unrelated_questions_stay_on_the_sampled_path():
+    assert not _is_factual_query("hello", [])
+    assert not _is_factual_query("Tell me a joke", [])
+
+
+def test_only_first_turns_are_routed():
+    history = [{"role": "user", "content": "hi"}]
+    assert not _is_factual_query("What is my balance?", history)
+
+
+def test_backend_banner_is_ignored():
+    # The banner mentions "previous instructions"; it must not decide routing.
+    assert not _is_factual_query(BANNER + "hello", [])
+    assert _is_factual_query(BANNER + "What is my balance?", [])
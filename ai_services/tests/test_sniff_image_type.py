@@ -0,0 +1,24 @@
+from app import _sniff_image_type
+
+
+def test_recognizes_supported_signatures():
+    assert _sniff_image_type(b"\xff\xd8\xff\xe0\x00\x10JFIF") == "image/jpeg"
+    assert _sniff_image_type(b"\x89PNG\r\n\x1a\n\x00\x00\x00\rIHDR") == "image/png"
+    assert _sniff_image_type(b"RIFF\x24\x00\x00\x00WEBPVP8 ") == "image/webp"
+
+
+def test_rejects_other_formats():
+    assert _sniff_image_type(b"GIF89a\x01\x00") is None
+    assert _sniff_image_type(b"%PDF-1.7\n") is None
+    assert _sniff_image_type(b"") is None
+
+
+def test_rejects_riff_containers_that_are_not_webp():
+    assert _sniff_image_type(b"RIFF\x24\x00\x00\x00WAVEfmt ") is None
+    assert _sniff_image_type(b"RIFF\x24\x00\x00\x00AVI LIST") is None
+
+
+def test_rejects_truncated_headers():
+    assert _sniff_image_type(b"\xff\xd8") is None
+    assert _sniff_image_type(b"\x89PNG") is None
+    assert _sniff_image_type(b"RIFF\x24\x00\x00\x00WE") is None
@@ -0,0 +1,54 @@
+import pytest
+
+import ai
+from ai import _MESSAGE_OVERHEAD_TOKENS, _truncate_history
+
+
+class WordEncoding:
+    """One token per whitespace-separated word; keeps budgets easy to read."""
+
+    def encode(self, text, disallowed_special=()):
+        return text.split()
+
+
+@pytest.fixture(autouse=True)
+def word_encoding(monkeypatch):
+    monkeypatch.setattr(ai, "get_encoding", WordEncoding)
+
+
+def message(role, words):
+    return {"role": role, "content": " ".join(["w"] * words)}
+
+
+def cost(words):
+    return words + _MESSAGE_OVERHEAD_TOKENS
+
+
+def test_keeps_everything_within_budget():
+    history = [message("user", 3), message("assistant", 5)]
+    assert _truncate_history(history, max_tokens=cost(3) + cost(5)) == history
+
+
+def test_drops_oldest_messages_first():
+    history = [message("user", 10), message("assistant", 2), message("user", 3)]
+    assert _truncate_history(history, max_tokens=cost(2) + cost(3)) == history[1:]
+
+
+def test_stops_at_first_message_that_does_not_fit():
+    # The oldest message would fit, but keeping it would leave a gap.
+    history = [message("user", 1), message("assistant", 50), message("user", 1)]
+    assert _truncate_history(history, max_tokens=cost(1) * 2) == history[2:]
+
+
+def test_newest_message_over_budget_drops_all_history():
+    history = [message("user", 1), message("assistant", 50)]
+    assert _truncate_history(history, max_tokens=cost(10)) == []
+
+
+def test_missing_or_null_content_counts_as_empty():
+    history = [{"role": "user"}, {"role": "assistant", "content": None}]
+    assert _truncate_history(history, max_tokens=cost(0) * 2) == history
+
+
+def test_empty_history():
+    assert _truncate_history([], max_tokens=100) == []